@@ -4,6 +4,14 @@
 # original telnetlib
 #
 import asyncio
+import atexit
+import concurrent.futures
+import re
+import select
+import socket
+import threading
+import time
+import weakref
 
 try:
     import telnetlib
@@ -11,12 +19,147 @@ try:
 except ImportError:
     _has_telnetlib = False
 
+try:
+    import uvloop
+    _loop_factory = uvloop.new_event_loop
+except ImportError:
+    _loop_factory = asyncio.new_event_loop
+
+# A single event loop is shared by all asyncio-based wrappers.
+# It is created on first use and runs forever in a daemon thread;
+# wrapper methods submit coroutines to it from the calling thread.
+_shared_loop = None
+_shared_loop_thread = None
+_shared_loop_lock = threading.Lock()
+
+# Open asyncio wrappers, so coalesced writes can be sent at exit
+_wrappers = weakref.WeakSet()
+
+# Small writes are coalesced and sent together after a short delay,
+# or immediately once the pending buffer reaches the size limit.
+_WRITE_COALESCE_DELAY = 0.001
+_WRITE_COALESCE_LIMIT = 4096
+
+# How long interpreter exit waits for coalesced writes to be sent
+_EXIT_FLUSH_TIMEOUT = 1.0
+
+# Default size for chunked reads
+_READ_CHUNK = 65536
+
+# Telnet command prefix, and the bytes telnetlib silently drops
+_IAC = b"\xff"
+_TELNET_DROP = b"\x00\x11"
+_TELNET_DROP_RE = re.compile(b"[" + re.escape(_TELNET_DROP) + b"]")
+
+def _get_loop():
+    global _shared_loop, _shared_loop_thread
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = _loop_factory()
+            _shared_loop_thread = threading.Thread(target=_shared_loop.run_forever,
+                                                   name="telnet-loop", daemon=True)
+            _shared_loop_thread.start()
+            atexit.register(_stop_loop)
+        return _shared_loop
+
+async def _flush_wrappers():
+    for wrapper in list(_wrappers):
+        if wrapper.writer is not None and not wrapper.writer.is_closing():
+            try:
+                await wrapper._flush()
+            except Exception:
+                # One dead connection shouldn't keep the others' writes back
+                pass
+
+def _stop_loop():
+    # Don't lose writes that are still waiting on the coalescing timer,
+    # but don't let a peer that stopped reading hang interpreter exit
+    future = asyncio.run_coroutine_threadsafe(
+        asyncio.wait_for(_flush_wrappers(), _EXIT_FLUSH_TIMEOUT), _shared_loop)
+    try:
+        # wait_for() cancels the flush cleanly on the loop; the timeout
+        # here only guards against the loop itself being stuck
+        future.result(2 * _EXIT_FLUSH_TIMEOUT)
+    except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+        future.cancel()
+    finally:
+        _shared_loop.call_soon_threadsafe(_shared_loop.stop)
+        _shared_loop_thread.join()
+        _shared_loop.close()
+
+def _set_nodelay(sock):
+    # Commands are short and latency-sensitive; don't let Nagle hold them
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def _resolve(future, func, args):
+    try:
+        future.set_result(func(*args))
+    except BaseException as e:
+        future.set_exception(e)
+
+def _drain_reader(reader, n=None):
+    # Take up to n bytes out of the reader's buffer in place, keeping
+    # the bytearray that the protocol's feed_data() extends
+    if reader.exception() is not None:
+        # Same as StreamReader.read(): a lost connection is an error
+        raise reader.exception()
+    buffer = reader._buffer
+    if not buffer:
+        return b""
+    if n is None or n >= len(buffer):
+        data = bytes(buffer)
+        del buffer[:]
+    else:
+        data = bytes(buffer[:n])
+        del buffer[:n]
+    reader._maybe_resume_transport()
+    return data
+
+def _drain_reader_into(reader, buf):
+    # Like _drain_reader(), but copies into a caller-supplied buffer
+    if reader.exception() is not None:
+        raise reader.exception()
+    buffer = reader._buffer
+    n = min(len(buf), len(buffer))
+    if n:
+        with memoryview(buffer) as view:
+            buf[:n] = view[:n]
+        del buffer[:n]
+        reader._maybe_resume_transport()
+    return n
+
+async def _async_read_until(reader, expected, timeout):
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    parts = []
+    while True:
+        remaining = None if deadline is None else deadline - loop.time()
+        try:
+            parts.append(await asyncio.wait_for(reader.readuntil(expected),
+                                                timeout=remaining))
+            break
+        except asyncio.IncompleteReadError as e:
+            # Connection closed
+            parts.append(e.partial)
+            break
+        except asyncio.LimitOverrunError as e:
+            # Response is longer than the reader's buffer limit; take the
+            # part already searched and keep looking in the rest
+            parts.append(await reader.readexactly(e.consumed))
+        except asyncio.TimeoutError:
+            # Return partial data on timeout
+            parts.append(_drain_reader(reader))
+            break
+    return b"".join(parts)
+
 class BaseTelnetWrapper:
     def open(self, host, port=23, **kwargs): raise NotImplementedError
     def read_until(self, expected, timeout=None): raise NotImplementedError
     def read_some(self): raise NotImplementedError
     def read_eager(self): raise NotImplementedError
+    def read_into(self, buf): raise NotImplementedError
     def write(self, buffer): raise NotImplementedError
+    def flush(self): raise NotImplementedError
     def close(self): raise NotImplementedError
     def __enter__(self): return self
     def __exit__(self, exc_type, exc_val, exc_tb): self.close()
@@ -25,14 +168,83 @@ class BaseTelnetWrapper:
 class StdlibTelnetWrapper(BaseTelnetWrapper):
     def __init__(self, host=None, port=23, **kwargs):
         self._telnet = None
+        self._epoll = None
+        # Receive buffer reused by read_bulk()
+        self._rbuf = bytearray(_READ_CHUNK)
+        self._rview = memoryview(self._rbuf)
         if host:
             self.open(host, port, **kwargs)
 
     def open(self, host, port=23, **kwargs):
         self._telnet = telnetlib.Telnet(host, port, **kwargs)
+        _set_nodelay(self._telnet.sock)
+        # On Linux, register the socket once instead of building a
+        # select() set on every wait
+        if self._epoll is not None:
+            self._epoll.close()
+            self._epoll = None
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+            self._epoll.register(self._telnet.sock, select.EPOLLIN)
+
+    def _wait_readable(self, timeout):
+        if self._epoll is not None:
+            return bool(self._epoll.poll(-1 if timeout is None else timeout))
+        ready, _, _ = select.select([self._telnet.sock], [], [], timeout)
+        return bool(ready)
 
     def read_until(self, expected, timeout=None):
-        return self._telnet.read_until(expected, timeout)
+        return self.read_bulk(expected, timeout)
+
+    def read_bulk(self, expected, timeout=None):
+        """
+        Like read_until(), but read the socket in large chunks and only
+        run telnetlib's per-byte option parser on chunks that contain
+        telnet commands.
+        """
+        t = self._telnet
+        # Start from whatever telnetlib has already received
+        t.process_rawq()
+        buf = bytearray(t.cookedq)
+        t.cookedq = b""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        search_from = 0
+        while True:
+            idx = buf.find(expected, search_from)
+            if idx >= 0 or t.eof:
+                break
+            # Only a match straddling the old end can start before here
+            search_from = max(0, len(buf) - len(expected) + 1)
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not self._wait_readable(remaining):
+                break
+            n = t.sock.recv_into(self._rview)
+            chunk = self._rview[:n]
+            if not n:
+                t.eof = True
+            elif t.iacseq or t.sb or self._rbuf.find(_IAC, 0, n) >= 0:
+                # Telnet commands present (or one is still in progress)
+                t.rawq += chunk
+                t.process_rawq()
+                buf += t.cookedq
+                t.cookedq = b""
+            elif _TELNET_DROP_RE.search(self._rbuf, 0, n):
+                buf += bytes(chunk).translate(None, _TELNET_DROP)
+            else:
+                buf += chunk
+            # Stop at the deadline even if data keeps arriving, as
+            # telnetlib does
+            if deadline is not None and time.monotonic() >= deadline:
+                idx = buf.find(expected, search_from)
+                break
+        if idx >= 0:
+            # Keep anything past the match queued for the next read
+            end = idx + len(expected)
+            t.cookedq = bytes(buf[end:])
+            del buf[end:]
+        if not buf and t.eof:
+            raise EOFError('telnet connection closed')
+        return bytes(buf)
 
     def read_some(self):
         return self._telnet.read_some()
@@ -40,85 +252,165 @@ class StdlibTelnetWrapper(BaseTelnetWrapper):
     def read_eager(self):
         return self._telnet.read_eager()
 
+    def read_into(self, buf):
+        """
+        Like read_eager(), but copy into buf instead of allocating.
+        Returns the number of bytes copied.
+        """
+        t = self._telnet
+        # Same readiness check as telnetlib's read_eager()
+        t.process_rawq()
+        while not t.cookedq and not t.eof and t.sock_avail():
+            t.fill_rawq()
+            t.process_rawq()
+        if not t.cookedq and t.eof and not t.rawq:
+            raise EOFError('telnet connection closed')
+        n = min(len(buf), len(t.cookedq))
+        with memoryview(t.cookedq) as view:
+            buf[:n] = view[:n]
+        # Anything that didn't fit stays queued for the next read
+        t.cookedq = t.cookedq[n:]
+        return n
+
     def write(self, buffer):
         self._telnet.write(buffer)
 
+    def flush(self):
+        # telnetlib writes are sent immediately
+        pass
+
     def close(self):
+        if self._epoll is not None:
+            self._epoll.close()
+            self._epoll = None
         self._telnet.close()
 
 class AsyncRawTelnetWrapper(BaseTelnetWrapper):
     def __init__(self, host=None, port=23, **kwargs):
-        self._loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self._loop)
+        self._loop = _get_loop()
         self.reader = None
         self.writer = None
+        self._wbuf = bytearray()
+        self._flush_handle = None
+        _wrappers.add(self)
         if host:
             self.open(host, port, **kwargs)
 
+    def _run(self, coro):
+        # Run a coroutine on the shared loop thread and wait for its result
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _call_after_poll(self, func, *args):
+        # Run a plain function on the shared loop thread and wait for its
+        # result, without the task a coroutine would need. The function
+        # is deferred by one call_soon hop: I/O callbacks from the select()
+        # that wakes the loop run first, so data that select() saw in the
+        # socket is already in the reader's buffer.
+        future = concurrent.futures.Future()
+        self._loop.call_soon_threadsafe(self._loop.call_soon, _resolve, future, func, args)
+        return future.result()
+
     def open(self, host, port=23, **kwargs):
-        async def _open():
-            return await asyncio.open_connection(host, port, **kwargs)
-        self.reader, self.writer = self._loop.run_until_complete(_open())
+        self.reader, self.writer = self._run(asyncio.open_connection(host, port, **kwargs))
+        # asyncio usually does this already, but not every loop does
+        _set_nodelay(self.writer.get_extra_info('socket'))
 
     def read_until(self, expected: bytes, timeout=None) -> bytes:
-        async def _read_until():
-            buffer = b""
-            try:
-                while True:
-                    chunk = await asyncio.wait_for(self.reader.read(1024), timeout=timeout)
-                    if not chunk:
-                        # Connection closed
-                        break
-                    buffer += chunk
-                    if expected in buffer:
-                        break
-                return buffer
-            except asyncio.TimeoutError:
-                return buffer  # partial data on timeout
-        return self._loop.run_until_complete(_read_until())
-
-    def read_some(self, n=1024) -> bytes:
-        async def _read_some():
-            try:
-                data = await asyncio.wait_for(self.reader.read(n), timeout=0.0001)
-                return data
-            except asyncio.TimeoutError:
-                return b""
-        return self._loop.run_until_complete(_read_some())
+        # Queued ahead of the read, so any pending command is sent
+        # before we wait for the reply
+        self._loop.call_soon_threadsafe(self._send_pending)
+        return self._run(_async_read_until(self.reader, expected, timeout))
+
+    def _read_some(self, n):
+        self._send_pending()
+        # The loop thread keeps the transport reading, so anything that
+        # has arrived is already in the reader's buffer
+        return _drain_reader(self.reader, n)
+
+    def read_some(self, n=_READ_CHUNK) -> bytes:
+        return self._call_after_poll(self._read_some, n)
+
+    def _read_eager(self):
+        self._send_pending()
+        return _drain_reader(self.reader)
 
     def read_eager(self) -> bytes:
         """
         Read any bytes immediately available without blocking.
         Returns empty bytes if no data is ready.
         """
-        async def _read_eager():
-            # First, grab any data already buffered internally
-            buf = b""
-            if getattr(self.reader, "_buffer", None):
-                buf = self.reader._buffer
-                self.reader._buffer = b""
-            try:
-                more = await asyncio.wait_for(self.reader.read(1024), timeout=0.0001)
-                buf += more
-            except asyncio.TimeoutError:
-                pass
-            return buf
-        return self._loop.run_until_complete(_read_eager())
+        return self._call_after_poll(self._read_eager)
 
-    def write(self, data: bytes):
-        async def _write():
-            self.writer.write(data)
+    def _read_into(self, buf):
+        self._send_pending()
+        return _drain_reader_into(self.reader, buf)
+
+    def read_into(self, buf) -> int:
+        """
+        Like read_eager(), but copy into buf instead of allocating.
+        Returns the number of bytes copied.
+        """
+        return self._call_after_poll(self._read_into, buf)
+
+    def _send_pending(self):
+        # Hand all coalesced data to the transport in a single write
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._wbuf:
+            self.writer.write(bytes(self._wbuf))
+            self._wbuf.clear()
+
+    async def _flush(self):
+        self._send_pending()
+        # Only wait on the transport when it is building up a backlog,
+        # or when it is closing so that drain() reports the error
+        transport = self.writer.transport
+        if (transport.is_closing() or
+                transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1] // 2):
             await self.writer.drain()
-        self._loop.run_until_complete(_write())
 
-    def close(self):
+    async def _write(self, data):
+        # Buffered data is sent later, so report a dead connection now
+        # rather than losing the write
+        exc = self.reader.exception()
+        if exc is not None:
+            raise exc
+        if self.writer.is_closing():
+            raise ConnectionResetError('Connection lost')
+        self._wbuf.extend(data)
+        if len(self._wbuf) >= _WRITE_COALESCE_LIMIT:
+            await self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(_WRITE_COALESCE_DELAY,
+                                                       self._send_pending)
+
+    def write(self, data: bytes):
+        self._run(self._write(data))
+
+    def flush(self):
+        """
+        Send any coalesced writes immediately.
+        """
+        self._run(self._flush())
+
+    async def _close(self):
+        await self._flush()
         self.writer.close()
-        self._loop.run_until_complete(self.writer.wait_closed())
+        await self.writer.wait_closed()
+
+    def close(self):
+        self._run(self._close())
+
+# Implementation chosen once at import time
+_TelnetImpl = StdlibTelnetWrapper if _has_telnetlib else AsyncRawTelnetWrapper
 
 def TelnetWrapper(host=None, port=23, force_stdlib=False, **kwargs):
     """
     Factory function to get the appropriate Telnet wrapper instance.
     """
-    if _has_telnetlib:
+    if force_stdlib:
+        if not _has_telnetlib:
+            raise ImportError("force_stdlib requested but telnetlib is not available")
         return StdlibTelnetWrapper(host, port, **kwargs)
-    return AsyncRawTelnetWrapper(host, port, **kwargs)
+    return _TelnetImpl(host, port, **kwargs)
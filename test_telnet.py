@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#
+# Regression checks for the telnet wrappers against a local server.
+# Run with: python -m unittest test_telnet
+#
+
+import socket
+import threading
+import time
+import unittest
+
+import telnet
+
+def _serve(handler):
+    """
+    Accept one connection on a local port and pass it to handler
+    in a background thread. Returns the port.
+    """
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen()
+    def run():
+        conn, _ = sock.accept()
+        with conn:
+            handler(conn)
+        sock.close()
+    threading.Thread(target=run, daemon=True).start()
+    return sock.getsockname()[1]
+
+def _stream_forever(conn):
+    try:
+        while True:
+            conn.sendall(b"x" * 65536)
+    except OSError:
+        pass
+
+@unittest.skipUnless(telnet._has_telnetlib, "telnetlib not available")
+class StdlibReadUntilTest(unittest.TestCase):
+
+    def test_match_keeps_remainder(self):
+        port = _serve(lambda conn: (conn.sendall(b"abc\xff\xfd\x01SC"),
+                                    time.sleep(0.05),
+                                    conn.sendall(b"PI>rest"),
+                                    time.sleep(0.5)))
+        with telnet.StdlibTelnetWrapper("127.0.0.1", port) as t:
+            self.assertEqual(t.read_until(b"SCPI>", timeout=1), b"abcSCPI>")
+            self.assertEqual(t.read_until(b"rest", timeout=1), b"rest")
+
+    def test_timeout_while_data_keeps_arriving(self):
+        port = _serve(_stream_forever)
+        with telnet.StdlibTelnetWrapper("127.0.0.1", port) as t:
+            start = time.monotonic()
+            data = t.read_until(b"NEVER", timeout=0.5)
+            elapsed = time.monotonic() - start
+        self.assertTrue(data)
+        self.assertLess(elapsed, 2)
+
+if __name__ == "__main__":
+    unittest.main()